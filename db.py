@@ -0,0 +1,62 @@
+import os
+import importlib.util
+from functools import lru_cache
+from typing import Optional
+
+from dotenv import load_dotenv
+from pymongo import MongoClient
+from pymongo.collection import Collection
+from pymongo.database import Database
+from pymongo.errors import OperationFailure
+
+load_dotenv()
+
+def _available_compressors() -> str:
+    names = [name for name, module in (("zstd", "zstandard"), ("snappy", "snappy"))
+             if importlib.util.find_spec(module) is not None]
+    return ",".join(names)
+
+MONGO_URI = os.getenv("MONGO_URI", "mongodb://localhost:27017/")
+MONGO_DB = os.getenv("MONGO_DB", "bigdata")
+# compresión en el cable: se usa el primero que soporten cliente y servidor.
+# Por defecto solo zstd/snappy, y solo si sus paquetes (zstandard/python-snappy)
+# están instalados (si no, PyMongo avisa en cada corrida). zlib no se ofrece salvo
+# que se pida en MONGO_COMPRESSORS: cuesta CPU y no aporta en localhost.
+# Si no hay ninguno disponible, no se comprime.
+MONGO_COMPRESSORS = os.getenv("MONGO_COMPRESSORS") or _available_compressors()
+# conexiones que el pool mantiene abiertas en segundo plano (0 = solo las que se usan)
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", "0"))
+
+@lru_cache(maxsize=None)
+def get_client() -> MongoClient:
+    # un único cliente (y pool de conexiones) por proceso, compartido por ambos scripts
+    opts = {"compressors": MONGO_COMPRESSORS} if MONGO_COMPRESSORS else {}
+    return MongoClient(
+        MONGO_URI,
+        maxPoolSize=50,
+        minPoolSize=MONGO_MIN_POOL_SIZE,
+        uuidRepresentation="standard",
+        retryWrites=True,
+        **opts,
+    )
+
+def get_db() -> Database:
+    return get_client()[MONGO_DB]
+
+def ensure_indexes(col_titles: Collection, col_ratings: Optional[Collection] = None) -> None:
+    # idempotente: si el índice ya existe, create_index no hace nada.
+    # Llamar una vez por proceso: la primera vez sobre IMDb completo tarda (índice único tconst)
+    specs = [
+        (col_titles, [("titleType", 1), ("startYear", 1), ("primaryTitle", 1)], {}),
+        (col_titles, [("tconst", 1)], {"unique": True}),
+        (col_titles, [("tmdb.id", 1)], {}),
+    ]
+    if col_ratings is not None:
+        specs.append((col_ratings, [("tconst", 1)], {"unique": True}))
+    for col, keys, opts in specs:
+        try:
+            col.create_index(keys, **opts)
+        except OperationFailure as e:
+            # p.ej. tconst duplicados o usuario sin permisos: seguimos sin ese índice.
+            # Errores de conexión no se atrapan: sin servidor no tiene sentido seguir
+            print(f"WARN: no se pudo crear el índice {keys} en {col.name}: {e}")
@@ -1,22 +1,32 @@
 import os
-import pandas as pd
-from pymongo import MongoClient
+from pymongo.errors import OperationFailure
 from dotenv import load_dotenv
 from datetime import datetime
 
+from db import ensure_indexes, get_db
+
 load_dotenv()
 
-MONGO_URI = os.getenv("MONGO_URI", "mongodb://localhost:27017/")
-MONGO_DB = os.getenv("MONGO_DB", "bigdata")
 TITLES_COLLECTION = os.getenv("TITLES_COLLECTION", os.getenv("MONGO_COLLECTION", "ibdm"))
 RATINGS_COLLECTION = os.getenv("RATINGS_COLLECTION", "ratings")
 TMDB_REGION = os.getenv("TMDB_REGION", "US").upper()
 
-client = MongoClient(MONGO_URI)
-db = client[MONGO_DB]
+db = get_db()
 col_titles = db[TITLES_COLLECTION]
 col_ratings = db[RATINGS_COLLECTION]
 
+def _collect_provider_names(items, out: set) -> None:
+    # agrega a `out` los nombres de una lista de strings o dicts estilo TMDB
+    for x in items:
+        if isinstance(x, str):
+            name = x.strip()
+        elif isinstance(x, dict):
+            name = str(x.get("provider_name") or x.get("name") or "").strip()
+        else:
+            continue
+        if name:
+            out.add(name)
+
 def providers_to_list(pregion) -> list:
     """
     Acepta:
@@ -26,38 +36,21 @@ def providers_to_list(pregion) -> list:
     - None / tipos raros -> []
     Devuelve lista única ordenada alfabéticamente.
     """
-    if pregion is None:
-        return []
+    names = set()
 
     # Caso lista plana
     if isinstance(pregion, list):
-        names = []
-        for x in pregion:
-            if isinstance(x, str):
-                names.append(x.strip())
-            elif isinstance(x, dict):
-                name = x.get("provider_name") or x.get("name")
-                if name:
-                    names.append(str(name).strip())
-        return sorted(list(dict.fromkeys([n for n in names if n])))
+        _collect_provider_names(pregion, names)
 
     # Caso dict con llaves flatrate/rent/buy
-    if isinstance(pregion, dict):
-        names = []
+    elif isinstance(pregion, dict):
         for kind in ("flatrate", "rent", "buy"):
             arr = pregion.get(kind) or []
             if isinstance(arr, list):
-                for x in arr:
-                    if isinstance(x, str):
-                        names.append(x.strip())
-                    elif isinstance(x, dict):
-                        name = x.get("provider_name") or x.get("name")
-                        if name:
-                            names.append(str(name).strip())
-        return sorted(list(dict.fromkeys([n for n in names if n])))
+                _collect_provider_names(arr, names)
 
-    # Otro tipo
-    return []
+    # None u otro tipo -> lista vacía
+    return sorted(names)
 
 
 def coerce_year(v):
@@ -72,25 +65,36 @@ def coerce_year(v):
 # A) FIGHT CLUB → info + providers + avgRating
 # -------------------------------
 def show_fight_club_row(title="Fight Club", year=1999, region=TMDB_REGION):
-    # Traer título
-    doc = col_titles.find_one({
+    # Traer título + rating en un solo round-trip ($lookup por tconst)
+    match = {
         "titleType": "movie",
-        "primaryTitle": {"$regex": f"^{title}$", "$options": "i"},
+        "primaryTitle": title,  # igualdad exacta: usa el índice compuesto
         "startYear": year
-    })
+    }
+    pipeline = [
+        {"$match": match},
+        {"$limit": 1},
+        {"$lookup": {
+            "from": RATINGS_COLLECTION,
+            "localField": "tconst",
+            "foreignField": "tconst",
+            "as": "r"
+        }},
+        {"$addFields": {"avgRating": {"$arrayElemAt": ["$r.averageRating", 0]}}},
+        {"$project": {"r": 0}},
+    ]
+    try:
+        doc = next(col_titles.aggregate(pipeline), None)
+    except OperationFailure:
+        # p.ej. sin permisos de lectura sobre ratings: traemos el título sin rating
+        doc = col_titles.find_one(match)
     if not doc:
         print(f"No se encontró {title} ({year}).")
         return
 
-    # Traer rating por tconst (si existe la colección)
-    rating = None
-    try:
-        if col_ratings.count_documents({}, limit=1) > 0 and doc.get("tconst"):
-            r = col_ratings.find_one({"tconst": doc["tconst"]}, {"_id": 0, "averageRating": 1, "numVotes": 1})
-            rating = (r or {}).get("averageRating")
-    except Exception:
-        # si no existe la colección ratings, seguimos sin rating
-        pass
+    # sin colección ratings, sin match o sin permisos: avgRating queda en None.
+    # Sin tconst el $lookup une contra ratings con tconst nulo/ausente: lo ignoramos
+    rating = doc.get("avgRating") if doc.get("tconst") else None
 
     # Providers desde tmdb.providers.<REGION>
     tmdb = doc.get("tmdb", {})
@@ -105,69 +109,58 @@ def show_fight_club_row(title="Fight Club", year=1999, region=TMDB_REGION):
         "streamingProviders": providers
     }
 
-    df = pd.DataFrame([row])
+    # una sola fila: se imprime directo, sin armar un DataFrame
     print("\n=== Fight Club (resumen) ===")
-    print(df.to_string(index=False))
+    print(
+        f"{row['primaryTitle']} ({row['startYear']}) | genres={row['genres']} | "
+        f"avg={row['avgRating']} | providers={', '.join(row['streamingProviders'])}"
+    )
 
 # -------------------------------
 # B) Rating promedio por género (últimos 5 años)
 # -------------------------------
 def avg_rating_by_genre_last5():
+    import pandas as pd  # import diferido: solo esta sección usa pandas
+
     current_year = datetime.now().year
     min_year = current_year - 4  # últimos 5 años inclusive (ej: 2021..2025)
 
-    # Traemos solo películas en ese rango con campos relevantes
-    cursor = col_titles.find(
-        {"titleType": "movie", "startYear": {"$gte": min_year}},
-        {"_id": 0, "tconst": 1, "startYear": 1, "genres": 1}
-    )
-    titles = list(cursor)
-    if not titles:
-        print(f"No hay películas desde {min_year}.")
-        return
-
-    # DataFrame de títulos
-    df_t = pd.DataFrame(titles)
-    # coerce de startYear
-    df_t["startYear"] = df_t["startYear"].apply(coerce_year)
-
-    # Traemos ratings (si existe)
-    try:
-        ratings = list(col_ratings.find({}, {"_id": 0, "tconst": 1, "averageRating": 1}))
-        df_r = pd.DataFrame(ratings)
-        # Join por tconst
-        df = df_t.merge(df_r, on="tconst", how="left")
-    except Exception:
-        # si no hay ratings, seguimos con df_t y columna NaN
-        df = df_t.copy()
-        df["averageRating"] = pd.NA
-
-    # Limpiamos géneros
-    df["genres"] = df["genres"].fillna("")
-    # dividir string "A,B,C" → listas; explotar en filas
-    df["genres_list"] = df["genres"].apply(lambda s: [] if s in ("", "\\N") else [g.strip() for g in s.split(",") if g.strip()])
-    df = df.explode("genres_list")
-
-    # filtrar filas sin género o sin rating
-    df = df[(df["genres_list"].notna()) & (df["genres_list"] != "")]
-    df = df[df["averageRating"].notna()]
-
-    # agrupar por género y calcular promedio
-    out = (
-        df.groupby("genres_list", as_index=False)["averageRating"]
-          .mean()
-          .rename(columns={"genres_list": "genre", "averageRating": "avgRating"})
-          .sort_values(by=["avgRating", "genre"], ascending=[False, True])
-    )
+    # Todo el cálculo corre en Mongo: join con ratings por tconst, split de
+    # "A,B,C" en géneros y promedio por género; solo vuelven ~30 filas.
+    # Requiere MongoDB 4.0+ ($trim).
+    pipeline = [
+        {"$match": {"titleType": "movie", "startYear": {"$gte": min_year}}},
+        {"$lookup": {
+            "from": RATINGS_COLLECTION,
+            "localField": "tconst",
+            "foreignField": "tconst",
+            "as": "r"
+        }},
+        {"$unwind": "$r"},  # descarta películas sin rating
+        {"$project": {
+            "_id": 0,
+            "averageRating": "$r.averageRating",
+            "genre": {"$split": [{"$ifNull": ["$genres", ""]}, ","]}
+        }},
+        {"$unwind": "$genre"},
+        {"$addFields": {"genre": {"$trim": {"input": "$genre"}}}},
+        {"$match": {"genre": {"$nin": ["", "\\N"]}, "averageRating": {"$ne": None}}},
+        {"$group": {"_id": "$genre", "avgRating": {"$avg": "$averageRating"}}},
+        {"$sort": {"avgRating": -1, "_id": 1}},
+    ]
+    rows = list(col_titles.aggregate(pipeline, allowDiskUse=True))
 
     print(f"\n=== Rating promedio por género (películas desde {min_year}) ===")
-    if out.empty:
+    if not rows:
         print("No hay ratings para calcular promedios.")
-    else:
-        # formato 2 decimales
-        out["avgRating"] = out["avgRating"].round(2)
-        print(out.to_string(index=False))
+        return
+
+    out = pd.DataFrame(rows).rename(columns={"_id": "genre"})[["genre", "avgRating"]]
+    # formato 2 decimales
+    out["avgRating"] = out["avgRating"].round(2)
+    print(out.to_string(index=False))
 
 if __name__ == "__main__":
+    ensure_indexes(col_titles, col_ratings)
     show_fight_club_row(title="Fight Club", year=1999, region=TMDB_REGION)
     avg_rating_by_genre_last5()
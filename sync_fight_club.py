@@ -1,18 +1,34 @@
 import os
 import sys
 import json
-import re
-from typing import Dict, Any, Optional, List
+import atexit
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, Any, Optional, List, Tuple
 
 from dotenv import load_dotenv
-from pymongo import MongoClient
+from pymongo import UpdateOne, UpdateMany
 from pymongo.collection import Collection
+from pymongo.errors import BulkWriteError
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from db import ensure_indexes, get_db
+
+try:
+    import orjson
+except ImportError:  # opcional: sin orjson usamos json de la stdlib
+    orjson = None
+
+try:
+    from requests_cache import CachedSession
+except ImportError:  # opcional: sin requests_cache no hay caché en disco
+    CachedSession = None
 
 load_dotenv()
 
-MONGO_URI = os.getenv("MONGO_URI", "mongodb://localhost:27017/")
-MONGO_DB = os.getenv("MONGO_DB", "bigdata")
 MONGO_COLLECTION = os.getenv("MONGO_COLLECTION", "ibdm")
 TMDB_API_KEY = os.getenv("TMDB_API_KEY", "")
 TMDB_REGION = os.getenv("TMDB_REGION", "US").upper()
@@ -21,10 +37,67 @@ if not TMDB_API_KEY:
     print("ERROR: TMDB_API_KEY no configurada en .env")
     sys.exit(1)
 
+# Sesión HTTP compartida: reutiliza conexiones (keep-alive) entre llamadas a TMDB.
+# Con requests_cache las respuestas quedan en SQLite 24 h, así que volver a
+# correr el script no repite requests (la clave es URL + params).
+TMDB_BASE_URL = "https://api.themoviedb.org"
+TMDB_CACHE_PATH = os.getenv("TMDB_CACHE_PATH", "tmdb_cache.sqlite")
+if CachedSession is not None:
+    SESSION = CachedSession(
+        TMDB_CACHE_PATH,
+        expire_after=86400,
+        allowable_methods=["GET"],
+        stale_if_error=True,
+    )
+else:
+    SESSION = requests.Session()
+SESSION.headers.update({"Accept": "application/json"})
+# Máximo de requests a TMDB en vuelo: acota el pool de conexiones y los workers
+# de sync_many (más workers que conexiones = conexiones descartadas)
+TMDB_MAX_CONCURRENCY = 16
+# TMDB limita requests por segundo (no concurrentes): espaciamos el inicio de cada llamada
+TMDB_MAX_REQUESTS_PER_SECOND = float(os.getenv("TMDB_MAX_REQUESTS_PER_SECOND", "40"))
+SESSION.mount(TMDB_BASE_URL, HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=TMDB_MAX_CONCURRENCY,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504]),
+))
+atexit.register(SESSION.close)
+
+_TMDB_RATE_LOCK = threading.Lock()
+_tmdb_next_slot = 0.0
+
+def _tmdb_throttle() -> None:
+    # reserva el próximo turno libre (1 / rps segundos entre requests) y espera hasta él
+    global _tmdb_next_slot
+    with _TMDB_RATE_LOCK:
+        slot = max(time.monotonic(), _tmdb_next_slot)
+        _tmdb_next_slot = slot + 1.0 / TMDB_MAX_REQUESTS_PER_SECOND
+    delay = slot - time.monotonic()
+    if delay > 0:
+        time.sleep(delay)
+
+def tmdb_get(url: str, params: Dict[str, Any]) -> requests.Response:
+    _tmdb_throttle()
+    r = SESSION.get(url, params=params, timeout=20)
+    r.raise_for_status()
+    return r
+
+def parse_json(r: requests.Response) -> Any:
+    if orjson is not None:
+        try:
+            return orjson.loads(r.content)
+        except orjson.JSONDecodeError:
+            pass  # p.ej. cuerpo no UTF-8: dejamos que requests detecte el encoding
+    return r.json()
+
+def dumps_pretty(obj: Any) -> str:
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS).decode()
+    return json.dumps(obj, indent=2, ensure_ascii=False)
+
 def get_collection() -> Collection:
-    client = MongoClient(MONGO_URI, uuidRepresentation="standard")
-    db = client[MONGO_DB]
-    return db[MONGO_COLLECTION]
+    return get_db()[MONGO_COLLECTION]
 
 def to_int_or_none(v):
     try:
@@ -37,27 +110,25 @@ def to_int_or_none(v):
 def find_film(collection: Collection, title: str, year: int) -> Optional[Dict[str, Any]]:
     query = {
         "titleType": "movie",
-        "primaryTitle": {"$regex": f"^{re.escape(title)}$", "$options": "i"},
+        "primaryTitle": title,  # igualdad exacta: usa el índice compuesto
         "startYear": year
     }
     doc = collection.find_one(query)
     return doc
 
 def tmdb_search_movie(title: str, year: int) -> Optional[Dict[str, Any]]:
-    url = "https://api.themoviedb.org/3/search/movie"
+    url = f"{TMDB_BASE_URL}/3/search/movie"
     params = {"api_key": TMDB_API_KEY, "query": title, "year": year, "include_adult": False}
-    r = requests.get(url, params=params, timeout=20)
-    r.raise_for_status()
-    data = r.json()
+    r = tmdb_get(url, params)
+    data = parse_json(r)
     results = data.get("results", [])
     return results[0] if results else None
 
 def tmdb_get_providers(movie_id: int, region: str = "US") -> Dict[str, Any]:
-    url = f"https://api.themoviedb.org/3/movie/{movie_id}/watch/providers"
+    url = f"{TMDB_BASE_URL}/3/movie/{movie_id}/watch/providers"
     params = {"api_key": TMDB_API_KEY}
-    r = requests.get(url, params=params, timeout=20)
-    r.raise_for_status()
-    data = r.json() or {}
+    r = tmdb_get(url, params)
+    data = parse_json(r) or {}
     results = data.get("results", {})
     return results.get(region.upper(), {})  # keys: flatrate, rent, buy, link
 
@@ -73,7 +144,8 @@ def format_providers_entry(p: Dict[str, Any]) -> Dict[str, Any]:
         "buy": names("buy"),
     }
 
-def update_movie_with_tmdb(collection: Collection, mongo_id, tmdb_id: int, providers: Dict[str, Any]) -> None:
+def update_movie_with_tmdb(mongo_id, tmdb_id: int, providers: Dict[str, Any]) -> UpdateOne:
+    # Devuelve la operación para ejecutarla en lote con collection.bulk_write
     # Estructura sugerida en Mongo:
     # tmdb: { id: 550, providers: { US: { flatrate: [], rent: [], buy: [], link: "" } } }
     update = {
@@ -82,28 +154,93 @@ def update_movie_with_tmdb(collection: Collection, mongo_id, tmdb_id: int, provi
             f"tmdb.providers.{TMDB_REGION}": providers
         }
     }
-    collection.update_one({"_id": mongo_id}, update)
+    return UpdateOne({"_id": mongo_id}, update)
 
-def update_by_tmdb_id(collection: Collection, tmdb_id: int, providers: Dict[str, Any]) -> None:
-    collection.update_many(
+def update_by_tmdb_id(tmdb_id: int, providers: Dict[str, Any]) -> UpdateMany:
+    return UpdateMany(
         {"tmdb.id": tmdb_id},
         {"$set": {f"tmdb.providers.{TMDB_REGION}": providers}}
     )
 
+def _sync_one(collection: Collection, title: str, year: int) -> Dict[str, Any]:
+    # Mongo + TMDB para una película; se corta en el primer paso sin resultado
+    # (doc o hit en None) para no llamar a TMDB si la película no está en Mongo
+    spec: Dict[str, Any] = {"doc": None, "hit": None, "tmdb_id": None, "providers": None}
+    spec["doc"] = find_film(collection, title, year)
+    if not spec["doc"]:
+        return spec
+    spec["hit"] = tmdb_search_movie(title, year)
+    if not spec["hit"]:
+        return spec
+    spec["tmdb_id"] = int(spec["hit"]["id"])
+    spec["providers"] = format_providers_entry(tmdb_get_providers(spec["tmdb_id"], TMDB_REGION))
+    return spec
+
+def sync_many(titles: List[Tuple[str, int]], workers: int = 8) -> Dict[Tuple[str, int], Optional[int]]:
+    # Sincroniza varias películas en paralelo (I/O-bound: la espera es de red)
+    col = get_collection()
+    synced: Dict[Tuple[str, int], Optional[int]] = {}
+    ops: List[UpdateOne] = []
+    pending: List[Tuple[Tuple[str, int], int]] = []  # (película, tmdb_id) en el mismo orden que ops
+    with ThreadPoolExecutor(max_workers=min(workers, TMDB_MAX_CONCURRENCY)) as ex:
+        futures = {ex.submit(_sync_one, col, t, y): (t, y) for t, y in titles}
+        for fut in as_completed(futures):
+            key = futures[fut]
+            synced[key] = None
+            try:
+                spec = fut.result()
+            except Exception as e:
+                print(f"Error sincronizando {key[0]} ({key[1]}): {e}")
+                continue
+            if not spec["doc"]:
+                print(f"No se encontró {key[0]} ({key[1]}) en Mongo.")
+                continue
+            if not spec["hit"]:
+                print(f"TMDB: no se encontró {key[0]} ({key[1]}).")
+                continue
+            ops.append(update_movie_with_tmdb(spec["doc"]["_id"], spec["tmdb_id"], spec["providers"]))
+            pending.append((key, spec["tmdb_id"]))
+    if not ops:
+        return synced
+
+    # un solo round-trip a Mongo para todas las actualizaciones; solo se
+    # reportan como sincronizadas las que efectivamente se escribieron
+    failed = set()
+    try:
+        col.bulk_write(ops, ordered=False)
+    except BulkWriteError as e:
+        for err in e.details.get("writeErrors", []):
+            failed.add(err["index"])
+            key = pending[err["index"]][0]
+            print(f"Error escribiendo {key[0]} ({key[1]}) en Mongo: {err.get('errmsg')}")
+    for i, (key, tmdb_id) in enumerate(pending):
+        if i not in failed:
+            synced[key] = tmdb_id
+            print(f"{key[0]} ({key[1]}): tmdb.id={tmdb_id}")
+    print(f"\nMongo actualizado: {len(pending) - len(failed)} película(s) con tmdb.id y providers.")
+    return synced
+
+def parse_titles(args: List[str]) -> List[Tuple[str, int]]:
+    # argumentos en pares: "Fight Club" 1999 "Se7en" 1995
+    if len(args) % 2:
+        raise ValueError("se esperaban pares título año")
+    return [(args[i], int(args[i + 1])) for i in range(0, len(args), 2)]
+
 def main():
     col = get_collection()
 
     print("Colección Mongo:", col._name)
 
-    # 1) recuperar Fight Club (1999) y mostrar datos
-    doc = find_film(col, "Fight Club", 1999)
+    # 1) recuperar Fight Club (1999), buscarlo en TMDB y traer plataformas
+    spec = _sync_one(col, "Fight Club", 1999)
+    doc, hit = spec["doc"], spec["hit"]
 
     if not doc:
         print("No se encontró Fight Club (1999) en Mongo.")
         sys.exit(0)
 
     print("=== Documento en Mongo (Fight Club) ===")
-    print(json.dumps({
+    print(dumps_pretty({
         "id": str(doc.get("_id")),
         "tconst": doc.get("tconst"),
         "titleType": doc.get("titleType"),
@@ -113,31 +250,42 @@ def main():
         "endYear": to_int_or_none(doc.get("endYear")),
         "genres": doc.get("genres"),
         "tmdb": doc.get("tmdb", {})
-    }, indent=2, ensure_ascii=False))
+    }))
 
-    # 2) TMDB: buscar ID y obtener plataformas de streaming
-    hit = tmdb_search_movie("Fight Club", 1999)
+    # 2) TMDB: ID y plataformas de streaming
     if not hit:
         print("TMDB: no se encontró la película.")
         sys.exit(0)
 
-    tmdb_id = int(hit["id"])
+    tmdb_id = spec["tmdb_id"]
+    providers_fmt = spec["providers"]
     print(f"\nTMDB match: id={tmdb_id}, title={hit.get('title')} ({hit.get('release_date', '')})")
 
-    providers_raw = tmdb_get_providers(tmdb_id, TMDB_REGION)
-    providers_fmt = format_providers_entry(providers_raw)
-
     print("\n=== Plataformas de streaming (TMDB) ===")
-    print(json.dumps(providers_fmt, indent=2, ensure_ascii=False))
+    print(dumps_pretty(providers_fmt))
 
     # 3) Actualizar en Mongo: guardar tmdb.id y providers
-    update_movie_with_tmdb(col, doc["_id"], tmdb_id, providers_fmt)
+    col.bulk_write([update_movie_with_tmdb(doc["_id"], tmdb_id, providers_fmt)])
     print("\nMongo actualizado con tmdb.id y providers.")
 
     # 4) Ejemplo: actualizar por ID (si más tarde querés refrescar solo por tmdb_id)
     #    (descomentar para usar)
-    # update_by_tmdb_id(col, tmdb_id, providers_fmt)
+    # col.bulk_write([update_by_tmdb_id(tmdb_id, providers_fmt)])
     # print("Mongo refrescado por tmdb_id.")
 
 if __name__ == "__main__":
-    main()
+    # sin argumentos: detalle de Fight Club; con pares título/año: sincronización en lote
+    #   python sync_fight_club.py "Fight Club" 1999 "Se7en" 1995
+    # (argv se valida antes de tocar Mongo: crear índices puede tardar)
+    titles = None
+    if len(sys.argv) > 1:
+        try:
+            titles = parse_titles(sys.argv[1:])
+        except ValueError as e:
+            print(f"ERROR: {e}. Uso: python sync_fight_club.py \"Título\" AÑO [\"Título\" AÑO ...]")
+            sys.exit(2)
+    ensure_indexes(get_collection())
+    if titles:
+        sync_many(titles)
+    else:
+        main()